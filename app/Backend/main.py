@@ -1,15 +1,14 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 import uvicorn
 import asyncio
 import io
-import tempfile
 import os
-import uuid
 import logging
-import requests
-import json
+import httpx
+import orjson
 from dotenv import load_dotenv
 import base64
 
@@ -17,11 +16,72 @@ import base64
 load_dotenv()
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 
-# Setup logging
-logging.basicConfig(level=logging.INFO)
+# Setup logging, quieter by default in production
+default_log_level = "INFO" if os.getenv("ENVIRONMENT", "development") == "development" else "WARNING"
+logging.basicConfig(level=os.getenv("LOG_LEVEL", default_log_level).upper())
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+GROQ_TRANSCRIPTION_URL = "https://api.groq.com/openai/v1/audio/transcriptions"
+
+# Shared HTTP client so Groq requests reuse pooled keep-alive connections and
+# multiplex concurrent uploads over HTTP/2
+http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+    timeout=30.0
+)
+
+# Multipart framing for the transcription request, encoded once at import. Only
+# the audio changes between requests, so it is streamed between these parts as-is
+MULTIPART_BOUNDARY = os.urandom(16).hex()
+MULTIPART_CONTENT_TYPE = f"multipart/form-data; boundary={MULTIPART_BOUNDARY}"
+MULTIPART_PREFIX = (
+    f'--{MULTIPART_BOUNDARY}\r\n'
+    f'Content-Disposition: form-data; name="model"\r\n\r\n'
+    f'whisper-large-v3-turbo\r\n'
+    f'--{MULTIPART_BOUNDARY}\r\n'
+    f'Content-Disposition: form-data; name="language"\r\n\r\n'
+    f'en\r\n'
+    f'--{MULTIPART_BOUNDARY}\r\n'
+    f'Content-Disposition: form-data; name="file"; filename="audio.webm"\r\n'
+    f'Content-Type: audio/webm\r\n\r\n'
+).encode()
+MULTIPART_SUFFIX = f"\r\n--{MULTIPART_BOUNDARY}--\r\n".encode()
+
+# Transcription jobs are coalesced for a short window and dispatched together,
+# with at most MAX_INFLIGHT Groq requests running at once
+BATCH_INTERVAL_MS = 50
+MAX_BATCH = 8
+MAX_INFLIGHT = 32
+
+# Created in lifespan so they belong to the running event loop
+transcription_queue: "asyncio.Queue[tuple[bytes, asyncio.Future]]" = None
+inflight_requests: asyncio.Semaphore = None
+
+# Jobs being transcribed, referenced so they aren't garbage collected
+transcription_tasks: "set[asyncio.Task]" = set()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global transcription_queue, inflight_requests
+    transcription_queue = asyncio.Queue()
+    inflight_requests = asyncio.Semaphore(MAX_INFLIGHT)
+    batch_task = asyncio.create_task(batch_transcriptions())
+    yield
+    
+    # Stop collecting, then fail queued jobs and cancel running ones so no
+    # handler is left waiting before the HTTP client goes away
+    batch_task.cancel()
+    await asyncio.gather(batch_task, return_exceptions=True)
+    while not transcription_queue.empty():
+        _, future = transcription_queue.get_nowait()
+        future.cancel()
+    for task in transcription_tasks:
+        task.cancel()
+    await asyncio.gather(*transcription_tasks, return_exceptions=True)
+    await http_client.aclose()
+
+app = FastAPI(lifespan=lifespan)
 
 # Updated CORS configuration
 origins = [
@@ -32,18 +92,19 @@ origins = [
     "wss://e5c2-2407-d000-d-e7da-31c0-365e-f0dd-3320.ngrok.io"
 ]
 
+# CORS doesn't cover websocket upgrades, so /ws checks the Origin header itself.
+# Browsers send the page's http(s) origin, never a ws(s):// one
+ALLOWED_WS_ORIGINS = frozenset(origin for origin in origins if origin.startswith(("http://", "https://")))
+
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # Allows all origins
+    allow_origins=origins,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["authorization", "content-type"],
+    max_age=86400,  # Let browsers cache preflight responses for a day
 )
 
-# Create a temporary directory to store audio chunks
-TEMP_DIR = tempfile.mkdtemp()
-logger.info(f"Created temporary directory at {TEMP_DIR}")
-
 # Health check endpoint
 @app.get("/")
 async def root():
@@ -53,58 +114,136 @@ async def root():
 async def health_check():
     return JSONResponse(content={"status": "healthy", "service": "groq-transcriber-backend"})
 
+# EBML ID that opens each WebM file; a new one mid-buffer means the browser
+# started a new MediaRecorder on the same socket
+WEBM_EBML_ID = b"\x1a\x45\xdf\xa3"
+
+# EBML ID that opens each WebM cluster; audio is only decodable from a cluster start
+WEBM_CLUSTER_ID = b"\x1f\x43\xb6\x75"
+
 class ConnectionManager:
     def __init__(self):
         self.active_connections: dict[str, WebSocket] = {}
+        self.buffers: dict[str, bytearray] = {}
+        self.out_queues: dict[str, asyncio.Queue] = {}
+        self.writers: dict[str, asyncio.Task] = {}
+        self._next_id = 0
         
     async def connect(self, websocket: WebSocket) -> str:
         await websocket.accept()
-        client_id = str(uuid.uuid4())
+        # Ids only need to be unique within this process
+        self._next_id += 1
+        client_id = str(self._next_id)
         self.active_connections[client_id] = websocket
+        self.buffers[client_id] = bytearray()
+        self.out_queues[client_id] = asyncio.Queue()
+        self.writers[client_id] = asyncio.create_task(
+            self._write_messages(client_id, websocket)
+        )
         return client_id
         
     def disconnect(self, client_id: str):
         if client_id in self.active_connections:
             del self.active_connections[client_id]
+        if client_id in self.buffers:
+            del self.buffers[client_id]
+        if client_id in self.out_queues:
+            del self.out_queues[client_id]
+        if client_id in self.writers:
+            self.writers.pop(client_id).cancel()
             
-    async def send_text(self, client_id: str, message: str):
-        if client_id in self.active_connections:
-            await self.active_connections[client_id].send_text(message)
+    def pending_audio(self, client_id: str, final: bool = False) -> bytes:
+        """
+        Return the completed clusters not yet sent for transcription as a
+        standalone WebM file, or b"" if there are none. With final=True the
+        last cluster is treated as complete too, for when recording has stopped
+        """
+        buffer = self.buffers[client_id]
+        
+        # A recorder restart ends the previous stream, so all of its remaining
+        # clusters are complete. Send them and continue from the new header
+        restart = buffer.find(WEBM_EBML_ID, 1)
+        if restart != -1:
+            audio = b""
+            if buffer.find(WEBM_CLUSTER_ID, 0, restart) != -1:
+                with memoryview(buffer) as view:
+                    audio = bytes(view[:restart])
+            del buffer[:restart]
+            return audio or self.pending_audio(client_id, final)
+        
+        header_end = buffer.find(WEBM_CLUSTER_ID)
+        if header_end == -1:
+            # Header still incomplete, nothing decodable yet
+            return b""
+        
+        # The last cluster may still be receiving blocks, so only clusters
+        # before it are complete and safe to send
+        end = len(buffer) if final else buffer.rfind(WEBM_CLUSTER_ID, header_end + 1)
+        if end == -1:
+            return b""
+        
+        # The buffer holds the EBML header and track info followed by unsent
+        # clusters, so this prefix is already a decodable file
+        with memoryview(buffer) as view:
+            audio = bytes(view[:end])
+        
+        # Drop the sent clusters, keeping the header for the next delta
+        del buffer[header_end:end]
+        return audio
+            
+    def send_text(self, client_id: str, message: str):
+        if client_id in self.out_queues:
+            self.out_queues[client_id].put_nowait(message)
+            
+    async def _write_messages(self, client_id: str, websocket: WebSocket):
+        """
+        Drain a client's outbound queue onto its websocket
+        """
+        queue = self.out_queues[client_id]
+        while True:
+            message = await queue.get()
+            try:
+                await websocket.send_text(message)
+            except Exception as e:
+                logger.error(f"Error sending message: {str(e)}")
+                # Stop queueing messages that nothing will send
+                self.out_queues.pop(client_id, None)
+                return
 
 manager = ConnectionManager()
 
-async def transcribe_audio(audio_file_path):
+async def multipart_body(audio_data: bytes):
+    """
+    Stream the multipart request body without copying the audio into it
+    """
+    yield MULTIPART_PREFIX
+    yield audio_data
+    yield MULTIPART_SUFFIX
+
+async def transcribe_audio(audio_data: bytes):
     """
     Transcribe audio using Groq's Speech-to-Text API
     """
     try:
-        # Read the audio file directly
-        with open(audio_file_path, "rb") as audio_file:
-            audio_data = audio_file.read()
-        
         # Prepare headers for the API request
+        content_length = len(MULTIPART_PREFIX) + len(audio_data) + len(MULTIPART_SUFFIX)
         headers = {
             "Authorization": f"Bearer {GROQ_API_KEY}",
-            "Content-Type": "multipart/form-data"
-        }
-        
-        # Prepare the files for the API request
-        files = {
-            'file': (os.path.basename(audio_file_path), audio_data),
-            'model': (None, 'whisper-large-v3-turbo'),
-            'language': (None, 'en')
+            "Content-Type": MULTIPART_CONTENT_TYPE,
+            "Content-Length": str(content_length)
         }
         
         # Make the API request
-        response = requests.post(
-            "https://api.groq.com/openai/v1/audio/transcriptions",
-            headers={"Authorization": f"Bearer {GROQ_API_KEY}"},
-            files=files
-        )
+        async with inflight_requests:
+            response = await http_client.post(
+                GROQ_TRANSCRIPTION_URL,
+                headers=headers,
+                content=multipart_body(audio_data)
+            )
         
         # Check if the request was successful
         if response.status_code == 200:
-            result = response.json()
+            result = orjson.loads(response.content)
             return result.get("text", "")
         else:
             logger.error(f"Error from Groq API: {response.status_code} - {response.text}")
@@ -114,99 +253,111 @@ async def transcribe_audio(audio_file_path):
         logger.error(f"Error transcribing audio: {str(e)}")
         return f"Error: {str(e)}"
 
-async def process_audio_chunks(client_id, client_dir):
+async def run_transcription(audio_data: bytes, future: asyncio.Future):
     """
-    Process all audio chunks for a client and transcribe them
+    Transcribe one queued job and resolve its future as soon as it finishes
     """
     try:
-        # Get all chunk files
-        chunk_files = sorted([os.path.join(client_dir, f) for f in os.listdir(client_dir) if f.endswith('.webm')])
-        
-        if not chunk_files:
-            return "No audio chunks to process"
-        
-        # Combine all chunks into a single file
-        combined_file = os.path.join(client_dir, "combined.webm")
-        with open(combined_file, 'wb') as outfile:
-            for chunk_file in chunk_files:
-                with open(chunk_file, 'rb') as infile:
-                    outfile.write(infile.read())
+        transcription = await transcribe_audio(audio_data)
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    if not future.done():
+        future.set_result(transcription)
+
+async def batch_transcriptions():
+    """
+    Collect queued transcription jobs and dispatch each batch without waiting on it.
+    Jobs in a batch run independently so no client waits on another's request
+    """
+    while True:
+        batch = [await transcription_queue.get()]
         
-        # Transcribe the combined audio
-        transcription = await transcribe_audio(combined_file)
-        return transcription
+        # Give other clients the window to queue their jobs, then take up to a
+        # full batch. Sleeping instead of wait_for(get()) keeps cancellation
+        # reliable, since wait_for can swallow a cancel that races a get
+        try:
+            await asyncio.sleep(BATCH_INTERVAL_MS / 1000)
+        except asyncio.CancelledError:
+            # Shutting down mid-window, fail the job already taken off the queue
+            for _, future in batch:
+                future.cancel()
+            raise
+        while len(batch) < MAX_BATCH and not transcription_queue.empty():
+            batch.append(transcription_queue.get_nowait())
         
-    except Exception as e:
-        logger.error(f"Error processing audio chunks: {str(e)}")
-        return f"Error: {str(e)}"
+        for audio_data, future in batch:
+            task = asyncio.create_task(run_transcription(audio_data, future))
+            transcription_tasks.add(task)
+            task.add_done_callback(transcription_tasks.discard)
+
+async def queue_transcription(audio_data: bytes):
+    """
+    Queue audio for the next transcription batch and wait for its text
+    """
+    future = asyncio.get_running_loop().create_future()
+    await transcription_queue.put((audio_data, future))
+    return await future
+
+async def send_transcription(client_id: str, audio_data: bytes):
+    """
+    Transcribe audio and send the text back to the client
+    """
+    transcription = await queue_transcription(audio_data)
+    if transcription:
+        manager.send_text(client_id, transcription)
+        logger.debug("Sent transcription to client %s", client_id)
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
+    origin = websocket.headers.get("origin")
+    if origin not in ALLOWED_WS_ORIGINS:
+        logger.debug("Rejected websocket from origin %r", origin)
+        # Closing before accept() is sent as an HTTP 403, so the client never
+        # sees 4403; the frontend's onclose will keep retrying every 3s
+        await websocket.close(code=4403)
+        return
+    
     client_id = await manager.connect(websocket)
     logger.info(f"Client connected: {client_id}")
     
-    # Create a directory for this client's audio chunks
-    client_dir = os.path.join(TEMP_DIR, client_id)
-    os.makedirs(client_dir, exist_ok=True)
-    
     chunk_count = 0
     last_transcription_time = 0
     transcription_interval = 2  # seconds
     
     try:
         while True:
-            # Receive audio chunk
-            audio_data = await websocket.receive_bytes()
+            # Receive audio chunk, flushing the open cluster once the client
+            # goes quiet (e.g. recording stopped) so its tail isn't held back
+            try:
+                audio_data = await asyncio.wait_for(websocket.receive_bytes(), transcription_interval)
+            except asyncio.TimeoutError:
+                audio = manager.pending_audio(client_id, final=True)
+                if audio:
+                    await send_transcription(client_id, audio)
+                continue
             
-            # Save the chunk to a temporary file
-            chunk_filename = os.path.join(client_dir, f"chunk_{chunk_count}.webm")
-            with open(chunk_filename, "wb") as f:
-                f.write(audio_data)
+            # Append the chunk to the client's in-memory buffer
+            manager.buffers[client_id].extend(audio_data)
             
-            logger.info(f"Received and saved audio chunk {chunk_count} from client {client_id}")
+            logger.debug("Received and buffered audio chunk %d from client %s", chunk_count, client_id)
             chunk_count += 1
             
             # Process for transcription every few chunks
             current_time = asyncio.get_event_loop().time()
             if current_time - last_transcription_time >= transcription_interval and chunk_count > 1:
+                # Transcribe only the clusters completed since the last tick
+                audio = manager.pending_audio(client_id)
+                if not audio:
+                    continue
                 last_transcription_time = current_time
-                
-                # Process audio chunks in the background
-                transcription_task = asyncio.create_task(process_audio_chunks(client_id, client_dir))
-                
-                # Wait for transcription to complete
-                transcription = await transcription_task
-                
-                # Send transcription back to client
-                if transcription:
-                    await manager.send_text(client_id, transcription)
-                    logger.info(f"Sent transcription to client {client_id}")
+                await send_transcription(client_id, audio)
             
     except WebSocketDisconnect:
         logger.info(f"Client disconnected: {client_id}")
+    finally:
+        # Release the client's buffer, queue and writer however the loop ended
         manager.disconnect(client_id)
-        
-        # Final transcription before cleanup
-        try:
-            final_transcription = await process_audio_chunks(client_id, client_dir)
-            if final_transcription:
-                await manager.send_text(client_id, final_transcription)
-                logger.info(f"Sent final transcription to client {client_id}")
-        except Exception as e:
-            logger.error(f"Error sending final transcription: {str(e)}")
-        
-        # Clean up client directory when they disconnect
-        if os.path.exists(client_dir):
-            for file in os.listdir(client_dir):
-                try:
-                    os.remove(os.path.join(client_dir, file))
-                except Exception as e:
-                    logger.error(f"Error removing file: {str(e)}")
-            try:
-                os.rmdir(client_dir)
-                logger.info(f"Cleaned up directory for client {client_id}")
-            except Exception as e:
-                logger.error(f"Error removing directory: {str(e)}")
 
 if __name__ == "__main__":
     # Get port from environment variable for production deployment
@@ -215,10 +366,18 @@ if __name__ == "__main__":
     # In production, don't use reload
     is_dev = os.environ.get("ENVIRONMENT", "development") == "development"
     
+    # Production uses uvloop/httptools and one worker per CPU; reload only
+    # supports a single worker and uvloop isn't available on Windows
     uvicorn.run(
         "main:app", 
         host="0.0.0.0", 
         port=port, 
-        reload=is_dev
+        reload=is_dev,
+        loop="auto" if is_dev else "uvloop",
+        http="auto" if is_dev else "httptools",
+        ws="websockets",
+        ws_max_size=1024 * 1024,  # Audio chunks are ~100ms of opus, far below this
+        ws_ping_interval=30,
+        workers=1 if is_dev else (os.cpu_count() or 1)
     )
 
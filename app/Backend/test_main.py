@@ -0,0 +1,118 @@
+import asyncio
+import email
+
+import httpx
+
+import main
+from main import ConnectionManager, WEBM_CLUSTER_ID
+
+HEADER = b"\x1a\x45\xdf\xa3header"
+
+
+def make_manager(data: bytes) -> ConnectionManager:
+    manager = ConnectionManager()
+    manager.buffers["1"] = bytearray(data)
+    return manager
+
+
+def test_pending_audio_without_header():
+    manager = make_manager(b"\x1a\x45\xdf\xa3partial")
+
+    assert manager.pending_audio("1") == b""
+    assert manager.buffers["1"] == b"\x1a\x45\xdf\xa3partial"
+
+
+def test_pending_audio_first_tick():
+    cluster1 = WEBM_CLUSTER_ID + b"c1data"
+    cluster2 = WEBM_CLUSTER_ID + b"c2"
+    manager = make_manager(HEADER + cluster1 + cluster2)
+
+    # Only the completed first cluster is sent, with the header in front
+    assert manager.pending_audio("1") == HEADER + cluster1
+    assert manager.buffers["1"] == HEADER + cluster2
+
+
+def test_pending_audio_waits_for_cluster_to_complete():
+    manager = make_manager(HEADER + WEBM_CLUSTER_ID + b"c1data")
+
+    assert manager.pending_audio("1") == b""
+
+
+def test_pending_audio_delta_tick():
+    cluster1 = WEBM_CLUSTER_ID + b"c1data"
+    cluster2 = WEBM_CLUSTER_ID + b"c2data"
+    cluster3 = WEBM_CLUSTER_ID + b"c3"
+    manager = make_manager(HEADER + cluster1 + WEBM_CLUSTER_ID + b"c2")
+    manager.pending_audio("1")
+
+    manager.buffers["1"].extend(b"data" + cluster3)
+
+    # The delta carries the header and the newly completed cluster only
+    assert manager.pending_audio("1") == HEADER + cluster2
+    assert manager.buffers["1"] == HEADER + cluster3
+
+
+def test_pending_audio_final_includes_open_cluster():
+    cluster1 = WEBM_CLUSTER_ID + b"c1data"
+    manager = make_manager(HEADER + cluster1)
+
+    assert manager.pending_audio("1", final=True) == HEADER + cluster1
+    assert manager.pending_audio("1", final=True) == b""
+
+
+def test_pending_audio_recorder_restart():
+    old_cluster = WEBM_CLUSTER_ID + b"c1data"
+    new_header = b"\x1a\x45\xdf\xa3newheader"
+    new_cluster = WEBM_CLUSTER_ID + b"n1data"
+    manager = make_manager(HEADER + old_cluster + new_header + new_cluster + WEBM_CLUSTER_ID)
+
+    # The old stream is flushed whole, then deltas use the new header
+    assert manager.pending_audio("1") == HEADER + old_cluster
+    assert manager.pending_audio("1") == new_header + new_cluster
+
+
+def test_pending_audio_restart_before_any_cluster():
+    new_header = b"\x1a\x45\xdf\xa3newheader"
+    new_cluster = WEBM_CLUSTER_ID + b"n1data"
+    manager = make_manager(HEADER + new_header + new_cluster + WEBM_CLUSTER_ID)
+
+    assert manager.pending_audio("1") == new_header + new_cluster
+
+
+def parse_multipart(content_type: str, body: bytes):
+    message = email.message_from_bytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+    return {
+        part.get_param("name", header="content-disposition"): part
+        for part in message.get_payload()
+    }
+
+
+def test_multipart_body_parses():
+    async def collect():
+        return b"".join([part async for part in main.multipart_body(b"audio-bytes")])
+
+    parts = parse_multipart(main.MULTIPART_CONTENT_TYPE, asyncio.run(collect()))
+
+    assert parts["model"].get_payload() == "whisper-large-v3-turbo"
+    assert parts["language"].get_payload() == "en"
+    assert parts["file"].get_filename() == "audio.webm"
+    assert parts["file"].get_content_type() == "audio/webm"
+    assert parts["file"].get_payload(decode=True) == b"audio-bytes"
+
+
+def test_transcribe_audio_content_length_matches_body(monkeypatch):
+    requests = []
+
+    async def handler(request):
+        requests.append((request.headers, await request.aread()))
+        return httpx.Response(200, json={"text": "hello"})
+
+    async def transcribe():
+        monkeypatch.setattr(main, "inflight_requests", asyncio.Semaphore(1))
+        monkeypatch.setattr(main, "http_client", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+        return await main.transcribe_audio(b"audio-bytes")
+
+    assert asyncio.run(transcribe()) == "hello"
+    headers, body = requests[0]
+    assert int(headers["content-length"]) == len(body)
+    assert parse_multipart(headers["content-type"], body)["file"].get_payload(decode=True) == b"audio-bytes"